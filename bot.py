@@ -1,7 +1,20 @@
 import os
+import sys
+import mmap
+import asyncio
+import atexit
+import signal
 import discord
 from discord.ext import commands
 import json
+import logging
+from operator import attrgetter
+
+# Use orjson for faster (de)serialization when available
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson not installed, fall back to stdlib json
 
 # Load environment variables from .env file (for local testing)
 try:
@@ -20,33 +33,120 @@ intents.message_content = True
 
 bot = commands.Bot(command_prefix="pb!", intents=intents, help_command=None)
 
+log = logging.getLogger("prefix-bot")
+
 PREFIX_FILE = "prefixes.json"
+MMAP_THRESHOLD = 4096  # Prefix files at least this size are loaded via mmap
+UPDATE_CONCURRENCY = 5  # Max nickname edits in flight during updateall
 
 # ======================
 # STORAGE
 # ======================
 
+def _dumps(data):
+    """Serialize prefix data to UTF-8 encoded JSON bytes"""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    # Same layout as orjson's OPT_INDENT_2 so the file doesn't depend on which is installed
+    return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+def _loads(raw):
+    """Parse JSON from str or bytes"""
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 def load_prefixes():
     # Try to load from environment variable first (for cloud hosting)
     env_prefixes = os.getenv("ROLE_PREFIXES")
     if env_prefixes:
         try:
-            return json.loads(env_prefixes)
+            return _loads(env_prefixes)
         except:
             pass
     
     # Fallback to file storage
     if not os.path.exists(PREFIX_FILE):
         return {}
-    with open(PREFIX_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(PREFIX_FILE, "rb") as f:
+        # Large configs are mapped and handed to orjson without a copy,
+        # small ones are cheaper to read outright
+        if orjson and os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    return orjson.loads(view)
+        return _loads(f.read())
 
 def save_prefixes(data):
     # Save to file (will persist on Railway)
-    with open(PREFIX_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    # Serialize first, then write it out and swap in atomically
+    payload = memoryview(_dumps(data))
+    tmp_file = PREFIX_FILE + ".tmp"
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # os.write may write less than asked, keep going until it's all out
+        while payload:
+            payload = payload[os.write(fd, payload):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_file, PREFIX_FILE)
+
+def _parse_prefixes(data):
+    """Convert loaded prefix data to {role_id: prefix}, skipping unusable entries"""
+    # JSON only has string keys, keep role IDs as ints in memory
+    prefixes = {}
+    for key, prefix in data.items():
+        try:
+            role_id = int(key)
+        except ValueError:
+            log.warning("Ignoring prefix for invalid role ID %r", key)
+            continue
+        # Prefixes are interned so roles sharing a prefix share one string
+        prefixes[role_id] = sys.intern(prefix) if isinstance(prefix, str) else prefix
+    return prefixes
+
+role_prefixes = _parse_prefixes(load_prefixes())
+
+# Role IDs that have a prefix, rebuilt whenever role_prefixes changes
+_prefix_role_ids = frozenset()
+
+def _rebuild_index():
+    global _prefix_role_ids
+    _prefix_role_ids = frozenset(role_prefixes)
+
+_rebuild_index()
 
-role_prefixes = load_prefixes()
+# Pending changes are flushed by a background task instead of per command
+FLUSH_DELAY = 2.0
+_dirty = None  # asyncio.Event, created in setup_hook on the bot's own loop
+_flush_task = None
+
+async def _save_async(data):
+    """Save prefixes from a worker thread so the event loop isn't blocked"""
+    await asyncio.to_thread(save_prefixes, data)
+
+async def _flush_loop():
+    """Coalesce prefix changes into at most one write every FLUSH_DELAY seconds"""
+    try:
+        while True:
+            await _dirty.wait()
+            await asyncio.sleep(FLUSH_DELAY)
+            _dirty.clear()
+            try:
+                await _save_async(dict(role_prefixes))
+            except OSError as e:
+                log.error("Failed to save prefixes: %s", e)
+                _dirty.set()
+    except Exception:
+        log.exception("Prefix flush loop stopped, changes will only be saved on exit")
+        raise
+
+@atexit.register
+def _final_flush():
+    """Write any changes still pending when the bot shuts down"""
+    if _dirty is not None and _dirty.is_set():
+        save_prefixes(role_prefixes)
 
 # ======================
 # HELPERS
@@ -54,42 +154,46 @@ role_prefixes = load_prefixes()
 
 def get_display_roles(member):
     """Get all roles that have a configured prefix"""
-    return [r for r in member.roles if str(r.id) in role_prefixes]
+    return [r for r in member.roles if r.id in _prefix_role_ids]
 
 def get_highest_display_role(member):
     """Get the highest positioned role with a prefix"""
-    roles = get_display_roles(member)
-    if not roles:
-        return None
-    return max(roles, key=lambda r: r.position)
+    return max(get_display_roles(member), key=attrgetter("position"), default=None)
 
-async def apply_prefix(member, role):
-    """Apply a role's prefix to a member's nickname"""
-    prefix = role_prefixes.get(str(role.id))
-    if not prefix:
-        return
+def strip_prefix(name):
+    """Return the part of a nickname after an old " | " prefix"""
+    head, sep, tail = name.partition(" | ")
+    return tail if sep else name
 
-    # Get the base name to use
+def build_nickname(member, prefix):
+    """Build the prefixed nickname for a member"""
+    # Use the custom nickname without any old prefix, or the username
     current_nick = member.nick
-    
-    if current_nick and " | " in current_nick:
-        # User has an old prefix format, extract the name part after " | "
-        base_name = current_nick.split(" | ", 1)[1]
-    elif current_nick:
-        # User has a custom nickname without prefix
-        base_name = current_nick
-    else:
-        # No nickname set, use username
-        base_name = member.name
-    
-    nickname = f"{prefix} | {base_name}"
+    base_name = strip_prefix(current_nick) if current_nick else member.name
+    return f"{prefix} | {base_name}"
 
+async def set_nickname(member, nickname):
+    """Change a member's nickname, returns an error code or None on success"""
     try:
         await member.edit(nick=nickname)
+        return None
     except discord.Forbidden:
-        print(f"Cannot change nickname for {member.name} - insufficient permissions")
+        log.warning("Cannot change nickname for %s - insufficient permissions", member.name)
+        return "permission"
     except discord.HTTPException as e:
-        print(f"Failed to change nickname for {member.name}: {e}")
+        log.warning("Failed to change nickname for %s: %s", member.name, e)
+        return "http"
+
+async def apply_prefix(member, role):
+    """Apply a role's prefix to a member's nickname"""
+    prefix = role_prefixes.get(role.id)
+    if not prefix:
+        return
+
+    nickname = build_nickname(member, prefix)
+    if member.nick == nickname:
+        return
+    await set_nickname(member, nickname)
 
 # ======================
 # ADMIN COMMANDS
@@ -99,17 +203,19 @@ async def apply_prefix(member, role):
 @commands.has_permissions(administrator=True)
 async def setprefix(ctx, role: discord.Role, *, prefix: str):
     """Set a prefix for a role"""
-    role_prefixes[str(role.id)] = prefix
-    save_prefixes(role_prefixes)
+    role_prefixes[role.id] = sys.intern(prefix)
+    _rebuild_index()
+    _dirty.set()
     await ctx.send(f"✅ Prefix set for **{role.name}** → `{prefix}`")
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def removeprefix(ctx, role: discord.Role):
     """Remove a prefix from a role"""
-    if str(role.id) in role_prefixes:
-        role_prefixes.pop(str(role.id))
-        save_prefixes(role_prefixes)
+    if role.id in role_prefixes:
+        role_prefixes.pop(role.id)
+        _rebuild_index()
+        _dirty.set()
         await ctx.send(f"❌ Prefix removed for **{role.name}**")
     else:
         await ctx.send("❌ This role has no prefix.")
@@ -124,7 +230,7 @@ async def listprefixes(ctx):
     
     lines = []
     for role_id, prefix in role_prefixes.items():
-        role = ctx.guild.get_role(int(role_id))
+        role = ctx.guild.get_role(role_id)
         role_name = role.name if role else f"Unknown Role ({role_id})"
         lines.append(f"**{role_name}**: `{prefix}`")
     
@@ -134,11 +240,31 @@ async def listprefixes(ctx):
 @commands.has_permissions(administrator=True)
 async def updateall(ctx):
     """Update all members' prefixes based on current settings"""
-    count = 0
+    desired = {}
     for member in ctx.guild.members:
         role = get_highest_display_role(member)
         if role:
-            await apply_prefix(member, role)
+            nickname = build_nickname(member, role_prefixes[role.id])
+            # Skip members who already have the right nickname
+            if member.nick != nickname:
+                desired[member] = nickname
+
+    # Run edits concurrently, bounded to stay clear of rate limits
+    sem = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+    async def edit_one(member, nickname):
+        async with sem:
+            return await set_nickname(member, nickname)
+
+    results = await asyncio.gather(
+        *(edit_one(m, n) for m, n in desired.items()),
+        return_exceptions=True
+    )
+    count = 0
+    for member, result in zip(desired, results):
+        if isinstance(result, BaseException):
+            log.error("Nickname update failed for %s", member.name, exc_info=result)
+        elif result is None:
             count += 1
     
     await ctx.send(f"✅ Updated {count} member(s) with new prefixes!")
@@ -162,9 +288,9 @@ async def setname(ctx, member: discord.Member, *, new_name: str):
     # Check if they have a current nickname with a prefix
     current_nick = member.nick
     
-    if current_nick and " | " in current_nick:
-        # Extract the prefix part and apply to new name
-        prefix = current_nick.split(" | ")[0]
+    prefix, sep, _ = (current_nick or "").partition(" | ")
+    if sep:
+        # Keep the existing prefix part and apply to new name
         nickname = f"{prefix} | {new_name}"
     else:
         # No prefix found, check if they have a prefix role
@@ -174,7 +300,7 @@ async def setname(ctx, member: discord.Member, *, new_name: str):
             await ctx.send(f"❌ {member.mention} has no prefix set and no roles with prefixes.")
             return
         
-        prefix = role_prefixes.get(str(role.id))
+        prefix = role_prefixes.get(role.id)
         nickname = f"{prefix} | {new_name}"
     
     try:
@@ -192,7 +318,10 @@ async def setname(ctx, member: discord.Member, *, new_name: str):
 @bot.event
 async def on_member_update(before, after):
     """Automatically update nickname when roles change"""
-    if before.roles == after.roles:
+    # Compare role IDs once, ignore changes that don't involve any prefix role
+    before_ids = {r.id for r in before.roles}
+    after_ids = {r.id for r in after.roles}
+    if not (before_ids ^ after_ids) & _prefix_role_ids:
         return
 
     role = get_highest_display_role(after)
@@ -203,39 +332,59 @@ async def on_member_update(before, after):
 # MANUAL PREFIX SELECT
 # ======================
 
-class TagSelect(discord.ui.Select):
-    def __init__(self, member):
-        options = []
+# Replies for the error codes returned by set_nickname
+TAG_ERRORS = {
+    "permission": "❌ I don't have permission to change your nickname.",
+    "http": "❌ Failed to change your nickname.",
+}
+
+def build_tag_nickname(member, prefix):
+    """Build the nickname for a prefix picked from the tag menu"""
+    # Use current display name, but fall back to username if an old prefix exists
+    current_nick = member.nick
+    if current_nick and " | " in current_nick:
+        base_name = member.name
+    else:
+        base_name = member.display_name
+    return f"{prefix} | {base_name}"
+
+def build_tag_options(member):
+    """Build the prefix menu options for a member"""
+    options = []
+
+    # Add option to remove prefix
+    options.append(
+        discord.SelectOption(
+            label="Remove Prefix",
+            description="Clear your nickname",
+            value="clear",
+            emoji="🚫"
+        )
+    )
 
-        # Add option to remove prefix
+    # Add all available role prefixes
+    for role in sorted(get_display_roles(member), key=attrgetter("position"), reverse=True):
         options.append(
             discord.SelectOption(
-                label="Remove Prefix",
-                description="Clear your nickname",
-                value="clear",
-                emoji="🚫"
+                label=role_prefixes[role.id],
+                description=role.name,
+                value=str(role.id)  # Store role ID, not prefix text
             )
         )
 
-        # Add all available role prefixes
-        for role in sorted(get_display_roles(member), key=lambda r: r.position, reverse=True):
-            options.append(
-                discord.SelectOption(
-                    label=role_prefixes[str(role.id)],
-                    description=role.name,
-                    value=str(role.id)  # Store role ID, not prefix text
-                )
-            )
+    # If no prefixes available, show placeholder
+    if len(options) == 1:  # Only the "clear" option
+        options = [
+            discord.SelectOption(label="No prefixes available", value="none")
+        ]
 
-        # If no prefixes available, show placeholder
-        if len(options) == 1:  # Only the "clear" option
-            options = [
-                discord.SelectOption(label="No prefixes available", value="none")
-            ]
+    return options
 
+class TagSelect(discord.ui.Select):
+    def __init__(self, member):
         super().__init__(
             placeholder="Choose your prefix",
-            options=options,
+            options=build_tag_options(member),
             min_values=1,
             max_values=1
         )
@@ -259,73 +408,44 @@ class TagSelect(discord.ui.Select):
             )
             return
 
-        # Handle clearing nickname
+        user = interaction.user
+
         if choice == "clear":
-            try:
-                await interaction.user.edit(nick=None)
-                await interaction.response.send_message(
-                    "✅ Prefix removed. Your nickname has been cleared.",
-                    ephemeral=True
-                )
-            except discord.Forbidden:
+            # Handle clearing nickname
+            nickname = None
+            success = "✅ Prefix removed. Your nickname has been cleared."
+        else:
+            # Apply selected prefix
+            role = interaction.guild.get_role(int(choice))
+            
+            # Verify user still has this role
+            if not role or role not in user.roles:
                 await interaction.response.send_message(
-                    "❌ I don't have permission to change your nickname.",
+                    "❌ You no longer have access to this prefix.",
                     ephemeral=True
                 )
-            except discord.HTTPException:
+                return
+
+            prefix = role_prefixes.get(role.id)
+            if not prefix:
                 await interaction.response.send_message(
-                    "❌ Failed to change your nickname.",
+                    "❌ This prefix is no longer configured.",
                     ephemeral=True
                 )
-            return
-
-        # Apply selected prefix
-        role = interaction.guild.get_role(int(choice))
-        
-        # Verify user still has this role
-        if not role or role not in interaction.user.roles:
-            await interaction.response.send_message(
-                "❌ You no longer have access to this prefix.",
-                ephemeral=True
-            )
-            return
+                return
 
-        prefix = role_prefixes.get(str(role.id))
-        if not prefix:
-            await interaction.response.send_message(
-                "❌ This prefix is no longer configured.",
-                ephemeral=True
-            )
-            return
+            nickname = build_tag_nickname(user, prefix)
+            success = f"✅ Prefix changed to **{nickname}**"
 
-        # Use current nickname or username, but reset if old prefix exists
-        current_nick = interaction.user.nick
-        
-        if current_nick and " | " in current_nick:
-            # Has old prefix, use username
-            base_name = interaction.user.name
-        else:
-            # Use current display name
-            base_name = interaction.user.display_name
-        
-        nickname = f"{prefix} | {base_name}"
+        # Skip the API call if the nickname is already right
+        error = None
+        if user.nick != nickname:
+            error = await set_nickname(user, nickname)
 
-        try:
-            await interaction.user.edit(nick=nickname)
-            await interaction.response.send_message(
-                f"✅ Prefix changed to **{nickname}**",
-                ephemeral=True
-            )
-        except discord.Forbidden:
-            await interaction.response.send_message(
-                "❌ I don't have permission to change your nickname.",
-                ephemeral=True
-            )
-        except discord.HTTPException:
-            await interaction.response.send_message(
-                "❌ Failed to change your nickname.",
-                ephemeral=True
-            )
+        await interaction.response.send_message(
+            TAG_ERRORS[error] if error else success,
+            ephemeral=True
+        )
 
 class TagView(discord.ui.View):
     def __init__(self, member):
@@ -341,20 +461,42 @@ async def tag(ctx):
         delete_after=60
     )
 
+# Help text is constant, build both variants once
+USER_HELP = "**User Commands:**\npb!tag - Select your prefix\npb!help - Show this help"
+ADMIN_HELP = USER_HELP + "\n\n**Admin Commands:**\npb!setprefix @role prefix - Set role prefix\npb!removeprefix @role - Remove prefix\npb!listprefixes - List all prefixes\npb!updateall - Update all members\npb!updateuser @member - Update one member\npb!setname @member Name - Manually set member's display name"
+
 @bot.command()
 async def help(ctx):
     """Show all available commands"""
     is_admin = ctx.author.guild_permissions.administrator
-    
-    user_msg = "**User Commands:**\npb!tag - Select your prefix\npb!help - Show this help"
-    admin_msg = "\n\n**Admin Commands:**\npb!setprefix @role prefix - Set role prefix\npb!removeprefix @role - Remove prefix\npb!listprefixes - List all prefixes\npb!updateall - Update all members\npb!updateuser @member - Update one member\npb!setname @member Name - Manually set member's display name"
-    
-    await ctx.send(user_msg + (admin_msg if is_admin else ""))
+    await ctx.send(ADMIN_HELP if is_admin else USER_HELP)
 
 # ======================
 # BOT EVENTS
 # ======================
 
+_close_task = None
+
+def _on_sigterm():
+    """Close the bot so bot.run returns and the atexit flush runs"""
+    global _close_task
+    # Keep a reference, the event loop only holds tasks weakly
+    _close_task = asyncio.create_task(bot.close())
+
+@bot.event
+async def setup_hook():
+    """Runs once on the bot's event loop before connecting"""
+    global _dirty, _flush_task
+    _dirty = asyncio.Event()
+    _flush_task = asyncio.create_task(_flush_loop())
+
+    # Hosts stop the worker with SIGTERM, close the bot so bot.run returns
+    # and the atexit flush gets to save any pending changes
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _on_sigterm)
+    except NotImplementedError:
+        pass  # Signal handlers aren't supported on Windows event loops
+
 @bot.event
 async def on_ready():
     print(f"✅ Logged in as {bot.user}")
@@ -364,4 +506,5 @@ async def on_ready():
 # RUN
 # ======================
 
-bot.run(os.getenv("BOT_TOKEN"))
\ No newline at end of file
+# root_logger=True lets discord.py's log handler format our logger's output too
+bot.run(os.getenv("BOT_TOKEN"), root_logger=True)
\ No newline at end of file